@@ -20,17 +20,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import BaseHTTPServer
 import csv
-import cStringIO
 import fnmatch
+import gzip
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
 import sqlite3
+import struct
 import sys
 import tempfile
+import urlparse
 
 from datetime import datetime
 
@@ -58,6 +62,21 @@ if sys.version_info[:2] == (2, 6):
 ORIG_DB = 'test.db'
 COPY_DB = None
 
+# Bump whenever the layout of a message record changes, so that stale cache
+# entries are ignored rather than misread.
+CACHE_VERSION = 4
+RECORD_FIELDS = ('date', 'is_from_me', 'handle', 'address', 'text', 'guid',
+                 'participants')
+
+# Fields of formatted messages, in output order.
+FIELDS = ('date', 'from', 'to', 'text')
+DIFF_FIELDS = ('change',) + FIELDS
+ALIGN = {'from': '>', 'to': '>'}
+
+# Bytes of `attributedBody` searched for the NSString class name, before
+# falling back to the whole blob.
+ATTRIBUTED_BODY_HEAD = 256
+
 def setup_and_parse(parser):
     """
     Set up ArgumentParser with all options and then parse_args().
@@ -83,11 +102,13 @@ def setup_and_parse(parser):
             metavar="FORMAT", default="%Y-%m-%d %H:%M:%S",
             help="Date format string. Optional. Default: '%(default)s'.")
                  
-    format_group.add_argument("-f", "--format", dest="format", 
-            choices = ['human', 'csv', 'json'], default = 'human', 
+    format_group.add_argument("-f", "--format", action="append",
+            dest="formats", metavar="FORMAT[:FILE]",
             help="How output is formatted. Valid options: 'human' "
-                 "(fields separated by pipe), 'csv', or 'json'. "
-                 "Optional. Default: '%(default)s'.")
+                 "(fields separated by pipe), 'csv', or 'json'. Optionally "
+                 "followed by ':FILE' to write this format to FILE instead "
+                 "of --output. Can be used multiple times to write several "
+                 "formats in one pass. Optional. Default: 'human'.")
                  
     format_group.add_argument("-m", "--myname", dest="identity", 
             metavar="NAME", default = 'Me',
@@ -122,6 +143,34 @@ def setup_and_parse(parser):
     input_group.add_argument("-i", "--input", dest="db_file", metavar="FILE",
             help="Name of SMS db file. Optional. Default: Script will find "
                  "and use db in standard backup location.")
+
+    input_group.add_argument("--diff", dest="old_db_file", metavar="OLD_FILE",
+            help="Name of SMS db file from an earlier backup of the same "
+                 "iPhone. Output only messages added since OLD_FILE, or "
+                 "deleted since OLD_FILE, with a 'change' column. Optional. "
+                 "Default (if not present): Output all messages.")
+
+    # Cache Options Group
+    cache_group = parser.add_argument_group('Cache Options')
+    cache_group.add_argument("--cache-dir", dest="cache_dir", metavar="DIR",
+            help="Directory in which to cache messages extracted from the "
+                 "SMS db. Later runs against the same db read messages from "
+                 "the cache instead of querying the db again. Optional. "
+                 "Default (if not present): No cache.")
+
+    cache_group.add_argument("--cache-size", dest="cache_size", type=int,
+            metavar="MB", default=100,
+            help="Maximum size of cache directory in megabytes. Oldest "
+                 "entries are removed first. Optional. "
+                 "Default: '%(default)s'.")
+
+    # Server Options Group
+    server_group = parser.add_argument_group('Server Options')
+    server_group.add_argument("--serve", dest="serve", metavar="[HOST:]PORT",
+            help="Instead of exporting messages, serve them as JSON over "
+                 "HTTP, one page of a conversation at a time. HOST defaults "
+                 "to 127.0.0.1. Optional. Default (if not present): Export "
+                 "messages and exit.")
             
     args = parser.parse_args()
     return args
@@ -206,6 +255,57 @@ def validate_numbers(numbers):
             if not valid_phone(n):
                 raise ValueError("OPTION ERROR: Invalid number in --number.")
 
+def split_format(spec):
+    """Split 'format[:file]' spec into (format, file). File may be None."""
+    if ':' in spec:
+        format, out_file = spec.split(':', 1)
+    else:
+        format, out_file = spec, None
+    return format, out_file or None
+
+def validate_formats(formats, out_file):
+    """
+    Raise exception if any format is unknown, or if two formats would be
+    written to the same file (or both to STDOUT).
+    """
+    if formats:
+        seen = set()
+        for spec in formats:
+            format, fmt_file = split_format(spec)
+            if format not in FORMATS:
+                raise ValueError("OPTION ERROR: Invalid --format. Should be "
+                                 "one of: %s." % ', '.join(FORMATS))
+            fmt_file = fmt_file or out_file
+            if fmt_file in seen:
+                raise ValueError("OPTION ERROR: Each --format needs its own "
+                                 "output file.")
+            seen.add(fmt_file)
+
+def split_serve(serve):
+    """Split '[host:]port' into (host, port).  Host defaults to 127.0.0.1."""
+    if ':' in serve:
+        host, port = serve.rsplit(':', 1)
+    else:
+        host, port = '127.0.0.1', serve
+    return host or '127.0.0.1', int(port)
+
+def validate_serve(serve):
+    """Raise exception if --serve is not in '[host:]port' format."""
+    if serve:
+        m = re.search(r'^([^:]*:)?\d+$', serve)
+        if not m:
+            raise ValueError("OPTION ERROR: Invalid --serve format. "
+                             "Should be '[host:]port'.")
+        host, port = split_serve(serve)
+        if not 0 < port < 65536:
+            raise ValueError("OPTION ERROR: Invalid port in --serve. "
+                             "Should be 1-65535.")
+
+def validate_cache_size(cache_size):
+    """Raise exception if cache size is not a positive number."""
+    if cache_size < 1:
+        raise ValueError("OPTION ERROR: --cache-size must be at least 1.")
+
 def validate(args):
     """
     Make sure aliases and numbers are valid.
@@ -215,6 +315,9 @@ def validate(args):
     try:
         validate_aliases(args.aliases)
         validate_numbers(args.numbers)
+        validate_formats(args.formats, args.output)
+        validate_cache_size(args.cache_size)
+        validate_serve(args.serve)
     except ValueError as err:
         print err, '\n'
         raise
@@ -269,6 +372,126 @@ def copy_sms_db(db):
         copy.close()
     return copy.name
 
+def db_fingerprint(db):
+    """
+    Return string that identifies the contents of db.
+
+    Combines size, mtime and SHA-1 hash of the file, so a new backup never
+    matches the cache entry of an old one.
+    """
+    try:
+        st = os.stat(db)
+        sha = hashlib.sha1()
+        with open(db, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), ''):
+                sha.update(chunk)
+    except (IOError, OSError, TypeError):
+        logging.error("Unable to open DB file: %s" % db)
+        sys.exit(1)
+    return "%d-%d-%s" % (st.st_size, int(st.st_mtime), sha.hexdigest())
+
+def cache_path(cache_dir, key):
+    """Return filename of cache entry for key."""
+    return os.path.join(cache_dir, key + '.msgs.gz')
+
+def load_cached_records(cache_dir, key):
+    """
+    Return list of message records cached for key, or None if not cached.
+
+    A hit refreshes the mtime of the entry, so that prune_cache() evicts
+    least recently used entries first.
+    """
+    path = cache_path(cache_dir, key)
+    try:
+        fh = gzip.open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        header = json.loads(fh.readline())
+        if header.get('version') != CACHE_VERSION:
+            logging.info("Ignoring cache entry %s from older version." % path)
+            return None
+        records = []
+        for line in fh:
+            row = json.loads(line)
+            if len(row) != len(RECORD_FIELDS):
+                raise ValueError("Bad row length")
+            record = dict(zip(RECORD_FIELDS, row))
+            if record['participants']:
+                record['participants'] = tuple(record['participants'])
+            records.append(record)
+    except Exception as e:
+        logging.warning("Ignoring unreadable cache entry %s: %s" % (path, e))
+        return None
+    finally:
+        fh.close()
+    os.utime(path, None)
+    logging.info("Read %d messages from cache: %s" % (len(records), path))
+    return records
+
+def save_cached_records(cache_dir, key, records, max_mb):
+    """
+    Write message records to cache entry for key, then prune cache.
+
+    Entry is gzipped JSON: a header line with CACHE_VERSION, then one list
+    per record, in RECORD_FIELDS order, to keep entries small.  Entry is
+    written to a tmp file first and renamed into place, so a partially
+    written entry is never read.
+    """
+    path = cache_path(cache_dir, key)
+    tmp = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.msgs.tmp',
+                                          delete=False)
+        fh = gzip.GzipFile(fileobj=tmp, mode='wb')
+        try:
+            fh.write(json.dumps({'version': CACHE_VERSION}) + '\n')
+            for r in records:
+                fh.write(json.dumps([r[f] for f in RECORD_FIELDS]) + '\n')
+        finally:
+            fh.close()
+            tmp.close()
+        os.rename(tmp.name, path)
+    except (IOError, OSError) as e:
+        logging.warning("Unable to write cache entry %s: %s" % (path, e))
+        if tmp and os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        return
+    logging.debug("Wrote %d messages to cache: %s" % (len(records), path))
+    prune_cache(cache_dir, max_mb * 1024 * 1024)
+
+def prune_cache(cache_dir, max_bytes):
+    """
+    Remove least recently used cache entries until under max_bytes.
+
+    Tmp files left by an interrupted save_cached_records() count toward
+    max_bytes, and are removed the same way.
+    """
+    entries = []
+    for basename in os.listdir(cache_dir):
+        if (fnmatch.fnmatch(basename, '*.msgs.gz') or 
+                fnmatch.fnmatch(basename, '*.msgs.tmp')):
+            path = os.path.join(cache_dir, basename)
+            entries.append((os.path.getmtime(path), 
+                            os.path.getsize(path), path))
+    entries.sort()
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        logging.info("Evicted cache entry: %s" % path)
+
+def connect_db(db):
+    """Return connection to db, with rows as sqlite3.Row and TRUNC()."""
+    conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("TRUNC", 1, trunc)
+    return conn
+
 def alias_map(aliases):
     """
     Convert .ini-style aliases to dict.
@@ -295,7 +518,8 @@ def which_db_version(cursor):
     Return version of DB schema as string.
 
     Return '5', if iOS 5.
-    Return '6', if iOS 6 or iOS 7.
+    Return '6', if iOS 6 or later.  (See ios6_schema() for differences
+    between later versions.)
 
     """
     query = "select count(*) from sqlite_master where name = 'handle'"
@@ -335,7 +559,8 @@ SELECT
     madrid_error,
     is_madrid, 
     madrid_date_read,
-    madrid_date_delivered
+    madrid_date_delivered,
+    madrid_guid
 FROM message """
     # Build up the where clause, if limiting query by phone.
     params = []
@@ -355,13 +580,46 @@ FROM message """
     query = query + "\nORDER by rowid"
     return query, tuple(params)
 
-def build_msg_query_ios6(numbers, emails):
+def has_column(cursor, table, column):
+    """Return True, if table has column."""
+    cursor.execute("PRAGMA table_info(%s)" % table)
+    return column in [row[1] for row in cursor.fetchall()]
+
+def ios6_schema(cursor):
+    """
+    Return dict describing how an iOS6 (or later) DB stores messages:
+
+        date_divisor: Divide `date` by this to get seconds since 2001.
+                      1 until iOS 11, then 10**9 (nanoseconds).
+        attributed_body: True, if message has `attributedBody` column,
+                      which holds the text when `text` is NULL.
+
+    Checked once per DB, not once per message.  The date unit is found from
+    the largest date: in seconds, it would be thousands of years from now.
+    """
+    cursor.execute("SELECT MAX(date) FROM message")
+    max_date = cursor.fetchone()[0] or 0
+    if max_date > 10 ** 11:
+        date_divisor = 10 ** 9
+    else:
+        date_divisor = 1
+    return {'date_divisor': date_divisor,
+            'attributed_body': has_column(cursor, 'message', 'attributedBody')}
+
+def build_msg_query_ios6(numbers, emails, attributed_body=False):
     """
     Build the query for SMS and iMessage messages for iOS6 DB.
 
+    If `attributed_body` is True, select `attributedBody` column too.
+    Otherwise, select NULL in its place.
+
+    Messages are left-joined to `handle` and `chat_message_join`, since 
+    messages sent to a group chat have no handle, only a chat.
+
     If `numbers` or `emails` is not None, that means we're querying for a
     subset of messages. Both phone number and email is stored in the `id`
-    field of the handle table.
+    field of the handle table. A group chat message matches if any member
+    of the chat matches.
 
     If `numbers` is None, then we select all messages.
 
@@ -373,29 +631,79 @@ SELECT
     m.date,
     m.is_from_me,
     h.id,
-    m.text
+    m.text,
+    m.guid,
+    cmj.chat_id,
+    %s AS attributedBody
 FROM
-    message m,
-    handle h
-WHERE
-    m.handle_id = h.rowid"""
+    message m
+LEFT JOIN handle h ON m.handle_id = h.rowid
+LEFT JOIN chat_message_join cmj ON cmj.message_id = m.rowid""" % \
+        ('m.attributedBody' if attributed_body else 'NULL')
     # Build up the where clause, if limiting query by phone and/or email.
     params = []
     or_clauses = []
     if numbers:
         for n in numbers:
-            or_clauses.append("TRUNC(h.id) = ?")
+            or_clauses.append("TRUNC(%(h)s.id) = ?")
             params.append(trunc(n))
     if emails:
         for e in emails:
-            or_clauses.append("h.id = ?")
+            or_clauses.append("%(h)s.id = ?")
             params.append(e)
     if or_clauses:
-        where = "\nAND\n(" + "\nOR ".join(or_clauses) + ")"
+        match = "\nOR ".join(or_clauses)
+        where = """
+WHERE
+(%s
+OR cmj.chat_id IN (
+    SELECT chj.chat_id
+    FROM chat_handle_join chj
+    JOIN handle h2 ON chj.handle_id = h2.rowid
+    WHERE %s))""" % (match % {'h': 'h'}, match % {'h': 'h2'})
         query = query + where
+        params = params * 2
     query = query + "\nORDER by m.rowid"
     return query, tuple(params)
 
+def index_chats(cursor):
+    """
+    Index chat_message_join on message_id, so that joining each message to
+    its chat is a lookup.  (Only ever run on the tmp copy of the DB.)
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS sms_backup_chat_msg_idx "
+                   "ON chat_message_join (message_id)")
+
+def load_participants(cursor):
+    """
+    Return tuple of two dicts, keyed by chat id:
+
+        group_chats: tuple of handles (run through normalize_handle()) of
+                     the members of each chat with more than one member.
+        single_chats: handle of the member of each chat with one member.
+
+    Messages in a one-member chat don't always have a handle of their own,
+    so single_chats supplies it.
+    """
+    cursor.execute("""
+SELECT
+    chj.chat_id,
+    h.id
+FROM chat_handle_join chj
+JOIN handle h ON chj.handle_id = h.rowid
+ORDER BY chj.chat_id, h.rowid""")
+    members = {}
+    for chat_id, address in cursor:
+        members.setdefault(chat_id, []).append(normalize_handle(address))
+    group_chats = {}
+    single_chats = {}
+    for chat_id, handles in members.iteritems():
+        if len(handles) > 1:
+            group_chats[chat_id] = tuple(handles)
+        else:
+            single_chats[chat_id] = handles[0]
+    return group_chats, single_chats
+
 def fix_imessage_date(seconds):
     """
     Convert seconds to unix epoch time.
@@ -430,100 +738,102 @@ def convert_date(unix_date, format):
     ds = dt.strftime(format)
     return ds.decode('utf-8')
 
-def convert_date_ios6(unix_date, format):
-    date = fix_imessage_date(unix_date)
-    return convert_date(date, format)
+def normalize_handle(address):
+    """Return email address unchanged, or phone number run through trunc()."""
+    m = re.search('@', address)
+    if m:
+        return address
+    return trunc(address)
 
-def convert_address_imessage(row, me, alias_map):
+def imessage_record(row):
     """
-    Find the iMessage address in row (a sqlite3.Row) and return a tuple of
-    address strings: (from_addr, to_addr).
+    Return normalized message record for iMessage row (a sqlite3.Row).
     
     In an iMessage message, the address could be an email or a phone number,
     and is found in the `madrid_handle` field.
     
-    Next, look for alias in alias_map.  Otherwise, use formatted address.
-    
     Use `madrid_flags` to determine direction of the message.  (See wiki
     page for Meaning of FLAGS fields discussion.)
         
     """
-    incoming_flags = (12289, 77825)
     outgoing_flags = (36869, 102405)
-    
-    if isinstance(me, str): 
-        me = me.decode('utf-8')
-        
-    # If madrid_handle is phone number, have to truncate it.
-    email_match = re.search('@', row['madrid_handle'])
-    if email_match:
-        handle = row['madrid_handle']
-    else:
-        handle = trunc(row['madrid_handle'])
-    
-    if handle in alias_map:
-        other = alias_map[handle]
-    else:
-        other = format_address(row['madrid_handle'])
-        
-    if row['madrid_flags'] in incoming_flags:
-        from_addr = other
-        to_addr = me
-    elif row['madrid_flags'] in outgoing_flags:
-        from_addr = me
-        to_addr = other
-        
-    return (from_addr, to_addr)
+    return {'date': imessage_date(row),
+            'is_from_me': row['madrid_flags'] in outgoing_flags,
+            'handle': normalize_handle(row['madrid_handle']),
+            'address': format_address(row['madrid_handle']),
+            'text': clean_text_msg(row['text']),
+            'guid': row['madrid_guid'],
+            'participants': None}
 
-def convert_address_sms(row, me, alias_map):
+def sms_record(row):
     """
-    Find the sms address in row (a sqlite3.Row) and return a tuple of address
-    strings: (from_addr, to_addr). 
+    Return normalized message record for sms row (a sqlite3.Row).
     
     In an SMS message, the address is always a phone number and is found in
     the `address` field.
     
-    Next, look for alias in alias_map.  Otherwise, use formatted address.
-    
     Use `flags` to determine direction of the message:
         2 = 'incoming'
         3 = 'outgoing'
     """
-    if isinstance(me, str): 
-        me = me.decode('utf-8')
+    return {'date': row['date'],
+            'is_from_me': row['flags'] == 3,
+            'handle': trunc(row['address']),
+            'address': format_phone(row['address']),
+            'text': clean_text_msg(row['text']),
+            'guid': None,
+            'participants': None}
+
+def ios6_record(row, handle, participants, date_divisor=1):
+    """
+    Return normalized message record for iOS6 row (a sqlite3.Row), sent to or
+    from `handle` (already run through normalize_handle()).
+
+    For group chat messages, `participants` is the tuple of handles of the
+    chat members.  Otherwise, None.
+
+    `date_divisor` comes from ios6_schema().  If `text` is NULL, text is
+    taken from `attributedBody`.
+    """
+    text = row['text']
+    if not text and row['attributedBody']:
+        text = attributed_body_text(row['attributedBody'])
+    return {'date': fix_imessage_date(row['date'] // date_divisor),
+            'is_from_me': bool(row['is_from_me']),
+            'handle': handle,
+            'address': handle,
+            'text': clean_text_msg(text),
+            'guid': row['guid'],
+            'participants': participants}
+
+def convert_address(record, me, alias_map):
+    """
+    Return a tuple of address strings for message record: (from_addr, to_addr).
     
-    tr_address = trunc(row['address'])
-    if tr_address in alias_map:
-        other = alias_map[tr_address]
-    else:
-        other = format_phone(row['address'])
-        
-    if row['flags'] == 2:
-        from_addr = other
-        to_addr = me
-    elif row['flags'] == 3:
-        from_addr = me
-        to_addr = other
-        
-    return (from_addr, to_addr)
+    Look for alias of the record's handle in alias_map.  Otherwise, use
+    formatted address.
 
-def convert_address_ios6(row, me, alias_map):
+    For group chats, the other side is a comma-separated list of the
+    members: all of them if sent by me, or me and the members other than
+    the sender if received.
+    """
     if isinstance(me, str):
         me = me.decode('utf-8')
 
-    address = row['id']
+    if record['participants']:
+        members = [alias_map.get(p, p) for p in record['participants'] 
+                   if p != record['handle'] or record['is_from_me']]
+        if record['is_from_me']:
+            return (me, u', '.join(members))
+        other = alias_map.get(record['handle'], record['address'])
+        return (other, u', '.join([me] + members))
 
-    # Truncate phone numbers, not email addresses.
-    m = re.search('@', address)
-    if not m:
-        address = trunc(address)
-
-    if address in alias_map:
-        other = alias_map[address]
+    if record['handle'] in alias_map:
+        other = alias_map[record['handle']]
     else:
-        other = address
+        other = record['address']
 
-    if row['is_from_me']:
+    if record['is_from_me']:
         from_addr = me
         to_addr = other
     else:
@@ -532,6 +842,62 @@ def convert_address_ios6(row, me, alias_map):
 
     return (from_addr, to_addr)
 
+def find_string_class(head):
+    """
+    Return (start, end) of NSString class name in typedstream header, or of
+    NSMutableString if the blob doesn't name NSString.  (-1, -1) if neither.
+    """
+    for name in ('NSString', 'NSMutableString'):
+        start = head.find(name)
+        if start != -1:
+            return start, start + len(name)
+    return -1, -1
+
+def attributed_body_text(blob):
+    """
+    Return text stored in `attributedBody` blob, or None if not found.
+
+    Blob is an NSAttributedString archived in NeXT typedstream format.  The
+    text follows the NSString (or NSMutableString) class name: a '+' marker,
+    then its length in bytes, then the utf-8 bytes.  Length is a single
+    byte, or 0x81 followed by 2 bytes, or 0x82 followed by 4 bytes
+    (little-endian).
+
+    The blob is read through a memoryview, so only the header (to find the
+    class name) and the text itself are ever copied.
+    """
+    view = memoryview(blob)
+    head = view[:ATTRIBUTED_BODY_HEAD].tobytes()
+    start, end = find_string_class(head)
+    if start == -1 and len(view) > ATTRIBUTED_BODY_HEAD:
+        head = view.tobytes()
+        start, end = find_string_class(head)
+    if start == -1:
+        return None
+    # The superclass chain may come between class name and the '+' type
+    # string (length 1, so preceded by 0x84 0x01).  Search the blob, not
+    # head: a class name near the end of head leaves the marker past it.
+    plus = view[end:end + 64].tobytes().find('\x84\x01+')
+    if plus == -1:
+        return None
+
+    pos = end + plus + 3
+    if pos >= len(view):
+        return None
+    size = ord(view[pos])
+    pos += 1
+    if size in (0x81, 0x82):
+        nbytes = 2 if size == 0x81 else 4
+        if pos + nbytes > len(view):
+            return None
+        size = 0
+        for i in range(nbytes):
+            size |= ord(view[pos + i]) << (8 * i)
+        pos += nbytes
+    if pos + size > len(view):
+        return None
+    return view[pos:pos + size].tobytes().decode('utf-8', 'replace')
+
 def clean_text_msg(txt):
     """
     Return cleaned-up text message.
@@ -607,46 +973,118 @@ def skip_imessage(row):
         retval = True
     return retval
 
-def get_messages(cursor, query, params, aliases, cmd_args):
+def skip_ios6(row, handle, participants):
+    """
+    Return True, if iOS6 row should be skipped.
+
+    A row needs a handle, except when I sent it to a group chat.  Rows 
+    received in a group chat without a sender are system messages (member
+    added or left, chat renamed).
+    """
+    retval = False
+    if not handle and not participants:
+        logging.info("Skipping msg (%s) without address or chat. "
+                        "Text: %s" % (row['rowid'], row['text']))
+        retval = True
+    elif not handle and not row['is_from_me']:
+        logging.info("Skipping msg (%s) in group chat without sender. "
+                        "(Probably member added or left, or chat renamed.) "
+                        "Text: %s" % (row['rowid'], row['text']))
+        retval = True
+    return retval
+
+def get_records(cursor, query, params):
+    """Run query on iOS5 DB and yield normalized message records."""
     cursor.execute(query, params)
     logging.debug("Run query: %s" % (query))
     logging.debug("With query params: %s" % (params,))
 
-    messages = []
     for row in cursor:
         if row['is_madrid'] == 1:
             if skip_imessage(row): continue
-            im_date = imessage_date(row)
-            fmt_date = convert_date(im_date, cmd_args.date_format)
-            fmt_from, fmt_to = convert_address_imessage(row, cmd_args.identity, aliases)
+            yield imessage_record(row)
         else:
             if skip_sms(row): continue
-            fmt_date = convert_date(row['date'], cmd_args.date_format)
-            fmt_from, fmt_to = convert_address_sms(row, cmd_args.identity, aliases)
-        msg = {'date': fmt_date,
-               'from': fmt_from,
-               'to': fmt_to,
-               'text': clean_text_msg(row['text'])}
-        messages.append(msg)
-    return messages
-
-def get_messages_ios6(cursor, query, params, aliases, cmd_args):
+            yield sms_record(row)
+
+def get_records_ios6(cursor, query, params, date_divisor=1):
+    """
+    Run query on iOS6 DB and yield normalized message records.
+
+    Members of each group chat are looked up once, before the query, not
+    once per message.
+    """
+    index_chats(cursor)
+    group_chats, single_chats = load_participants(cursor)
+    last_rowid = None
+
     cursor.execute(query, params)
     logging.debug("Run query: %s" % (query))
     logging.debug("With query params: %s" % (params,))
 
-    messages = []
     for row in cursor:
-        fmt_date = convert_date_ios6(row['date'], cmd_args.date_format)
-        fmt_from, fmt_to = convert_address_ios6(row, cmd_args.identity, aliases)
-        msg = {'date': fmt_date,
-               'from': fmt_from,
-               'to': fmt_to,
-               'text': clean_text_msg(row['text'])}
-        messages.append(msg)
-    return messages
+        # A message in more than one chat is returned once per chat.
+        if row['rowid'] == last_rowid: continue
+        last_rowid = row['rowid']
+        participants = group_chats.get(row['chat_id'])
+        if row['id']:
+            handle = normalize_handle(row['id'])
+        else:
+            handle = single_chats.get(row['chat_id'])
+        if skip_ios6(row, handle, participants): continue
+        yield ios6_record(row, handle, participants, date_divisor)
+
+def extract_records(cursor, numbers, emails):
+    """
+    Yield normalized message records from DB, limited to `numbers` and
+    `emails`, if present.
+    """
+    ios_db_version = which_db_version(cursor)
+    if ios_db_version == '5':
+        query, params = build_msg_query(numbers, emails)
+        return get_records(cursor, query, params)
+    elif ios_db_version == '6':
+        schema = ios6_schema(cursor)
+        query, params = build_msg_query_ios6(numbers, emails, 
+                                             schema['attributed_body'])
+        return get_records_ios6(cursor, query, params, 
+                                schema['date_divisor'])
+
+def filter_records(records, numbers, emails):
+    """
+    Yield records to/from `numbers` or `emails`.  If neither is present,
+    yield all records.
 
-def msgs_human(messages, header):
+    Same selection that build_msg_query() makes in SQL, for records read
+    from the cache.
+    """
+    wanted = set()
+    if numbers:
+        wanted.update(trunc(n) for n in numbers)
+    if emails:
+        wanted.update(emails)
+    for record in records:
+        if (not wanted or record['handle'] in wanted or 
+                wanted.intersection(record['participants'] or ())):
+            yield record
+
+def format_record(record, aliases, cmd_args):
+    """
+    Return message dict for output, formatted from normalized record.
+
+    Records from diff_records() also carry a 'change' field.
+    """
+    fmt_date = convert_date(record['date'], cmd_args.date_format)
+    fmt_from, fmt_to = convert_address(record, cmd_args.identity, aliases)
+    msg = {'date': fmt_date,
+           'from': fmt_from,
+           'to': fmt_to,
+           'text': record['text']}
+    if 'change' in record:
+        msg['change'] = record['change']
+    return msg
+
+def msgs_human(messages, header, fields=FIELDS):
     """
     Return messages, with optional header row. 
     
@@ -654,75 +1092,500 @@ def msgs_human(messages, header):
     
     date | from | to | text
     
-    Width of 'from' and 'to' columns is determined by widest column value
-    in messages, so columns align.
+    (With 'change' column first, for --diff.)
+
+    Width of each column but 'text' is determined by widest column value
+    in messages, so columns align.  'from' and 'to' are right-aligned.
     """
     output = ""
     if messages:
         # Figure out column widths 
-        max_from = max([len(x['from']) for x in messages])
-        max_to = max([len(x['to']) for x in messages])
-        max_date = max([len(x['date']) for x in messages])
-    
-        from_width = max(max_from, len('From'))
-        to_width = max(max_to, len('To'))
-        date_width = max(max_date, len('Date'))
+        columns = fields[:-1]
+        widths = [max(max([len(x[f]) for x in messages]), len(f)) 
+                  for f in columns]
+        headers_width = sum(widths) + 3 * len(columns)
+
+        templates = [u"{%d:%s{%d}}" % (2 * i, ALIGN.get(f, ''), 2 * i + 1)
+                     for i, f in enumerate(columns)]
+        template = u" | ".join(templates + [u"{%d}" % (2 * len(columns))])
+        htemplate = template.replace('>', '')
 
-        headers_width = from_width + to_width + date_width + 9
-    
         msgs = []
         if header:
-            htemplate = u"{0:{1}} | {2:{3}} | {4:{5}} | {6}"
-            hrow = htemplate.format('Date', date_width, 'From', from_width, 
-                                   'To', to_width, 'Text')
-            msgs.append(hrow)
+            values = []
+            for f, width in zip(columns, widths):
+                values.extend([f.capitalize(), width])
+            msgs.append(htemplate.format(*(values + [fields[-1].capitalize()])))
         for m in messages:
-            text = m['text'].replace("\n","\n" + " " * headers_width)
-            template = u"{0:{1}} | {2:>{3}} | {4:>{5}} | {6}"
-            msg = template.format(m['date'], date_width, m['from'], from_width, 
-                                  m['to'], to_width, text)
-            msgs.append(msg)
+            values = []
+            for f, width in zip(columns, widths):
+                values.extend([m[f], width])
+            text = m[fields[-1]].replace("\n","\n" + " " * headers_width)
+            msgs.append(template.format(*(values + [text])))
         msgs.append('')
         output = '\n'.join(msgs).encode('utf-8')
     return output
 
-def msgs_csv(messages, header):
-    """Return messages in .csv format."""
-    queue = cStringIO.StringIO()
-    writer = csv.writer(queue, dialect=csv.excel, quoting=csv.QUOTE_ALL)
-    if header:
-        writer.writerow(['Date', 'From', 'To', 'Text'])
-    for m in messages:
-        writer.writerow([m['date'].encode('utf-8'),
-                         m['from'].encode('utf-8'),
-                         m['to'].encode('utf-8'),
-                         m['text'].encode('utf-8')])
-    output = queue.getvalue()
-    queue.close()
-    return output
-
-def msgs_json(messages, header=False):
-    """Return messages in JSON format"""
-    output = json.dumps(messages, sort_keys=True, indent=2, ensure_ascii=False)
-    return output.encode('utf-8')
+def message_fingerprint(record, use_guid):
+    """
+    Return 64-bit fingerprint of message record, as an int.
 
-def output(messages, out_file, format, header):
-    """Output messages to out_file in format."""
-    if out_file:
-        fh = open(out_file, 'w')
+    Hash of guid, if `use_guid` and the message has one.  Otherwise, hash of
+    date, handle and text, which survive a change of DB schema.
+    """
+    if use_guid and record['guid']:
+        key = record['guid']
     else:
-        fh = sys.stdout
-        
-    if format == 'human': fmt_msgs = msgs_human
-    elif format == 'csv': fmt_msgs = msgs_csv
-    elif format == 'json': fmt_msgs = msgs_json
-    
+        key = u"%s\0%s\0%s" % (record['date'], 
+                                record['handle'] or 
+                                u','.join(record['participants'] or ()),
+                                record['text'])
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+def record_values(record):
+    """
+    Return tuple of record fields, in RECORD_FIELDS order, for the scratch
+    DB.  Participants are stored as one newline-separated string.
+    """
+    values = dict(record)
+    if record['participants']:
+        values['participants'] = u'\n'.join(record['participants'])
+    return tuple(values[f] for f in RECORD_FIELDS)
+
+def values_record(row):
+    """Return record from scratch DB row.  Inverse of record_values()."""
+    record = dict((f, row[f]) for f in RECORD_FIELDS)
+    if record['participants']:
+        record['participants'] = tuple(record['participants'].split(u'\n'))
+    return record
+
+def store_fingerprints(scratch, table, records, use_guid):
+    """Store records, with their fingerprints, in `table` of scratch DB."""
+    scratch.execute("CREATE TABLE %s (fp INTEGER, %s)" % \
+                        (table, ', '.join(RECORD_FIELDS)))
+    insert = "INSERT INTO %s VALUES (?, %s)" % \
+                (table, ', '.join('?' * len(RECORD_FIELDS)))
+    scratch.executemany(insert, 
+            ((message_fingerprint(r, use_guid),) + record_values(r)
+             for r in records))
+    scratch.commit()
+
+def merge_fingerprints(old_rows, new_rows):
+    """
+    Merge two cursors ordered by fingerprint, and yield (change, row) for
+    each row in only one of them: 'deleted' if in old_rows, 'added' if in
+    new_rows.  Duplicate fingerprints are matched one for one.
+    """
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old['fp'] < new['fp']):
+            yield 'deleted', old
+            old = next(old_rows, None)
+        elif old is None or new['fp'] < old['fp']:
+            yield 'added', new
+            new = next(new_rows, None)
+        else:
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+
+def diff_records(scratch, old_cursor, new_cursor, numbers, emails):
+    """
+    Yield records of messages added in new DB, or deleted from old DB, in 
+    date order.  Each record has a 'change' field: 'added' or 'deleted'.
+
+    Fingerprints of both DBs are stored in the scratch DB and read back in
+    sorted order, then merged.  SQLite sorts in temp files when a table
+    doesn't fit in memory, so memory use doesn't grow with the number of
+    messages.
+
+    Messages are matched on guid when both DBs have the same schema version.
+    Otherwise, guids aren't comparable, so they are matched on content.
+    """
+    use_guid = which_db_version(old_cursor) == which_db_version(new_cursor)
+    store_fingerprints(scratch, 'old_msgs', 
+            extract_records(old_cursor, numbers, emails), use_guid)
+    store_fingerprints(scratch, 'new_msgs', 
+            extract_records(new_cursor, numbers, emails), use_guid)
+
+    # Create table before opening the sorted cursors: DDL commits, and a
+    # commit resets every open cursor.
+    scratch.execute("CREATE TABLE delta (change, %s)" % \
+                        ', '.join(RECORD_FIELDS))
+    old_rows = scratch.execute("SELECT * FROM old_msgs ORDER BY fp")
+    new_rows = scratch.execute("SELECT * FROM new_msgs ORDER BY fp")
+    insert = "INSERT INTO delta VALUES (?, %s)" % \
+                ', '.join('?' * len(RECORD_FIELDS))
+    scratch.executemany(insert, 
+            ((change,) + tuple(row[f] for f in RECORD_FIELDS)
+             for change, row in merge_fingerprints(old_rows, new_rows)))
+    scratch.commit()
+
+    for row in scratch.execute("SELECT * FROM delta ORDER BY date, change"):
+        record = values_record(row)
+        record['change'] = row['change']
+        yield record
+
+def diff(cursor, aliases, cmd_args):
+    """Output messages that differ between old DB and DB open in cursor."""
+    old_copy = copy_sms_db(cmd_args.old_db_file)
+    scratch_file = tempfile.NamedTemporaryFile(delete=False)
+    scratch_file.close()
+    old_conn = None
+    scratch = None
     try:
-        fh.write(fmt_msgs(messages, header))
-    except:
-        raise
-        
-    fh.close()
+        old_conn = connect_db(old_copy)
+        scratch = sqlite3.connect(scratch_file.name)
+        scratch.row_factory = sqlite3.Row
+        scratch.execute("PRAGMA journal_mode = OFF")
+        scratch.execute("PRAGMA synchronous = OFF")
+        records = diff_records(scratch, old_conn.cursor(), cursor, 
+                               cmd_args.numbers, cmd_args.emails)
+        writers = open_writers(cmd_args.formats, cmd_args.output, 
+                               cmd_args.header, DIFF_FIELDS)
+        output(records, writers, aliases, cmd_args)
+    finally:
+        if scratch:
+            scratch.close()
+        if old_conn:
+            old_conn.close()
+        os.remove(scratch_file.name)
+        os.remove(old_copy)
+        logging.debug("Deleted copy of OLD_FILE: %s" % old_copy)
+
+class HumanWriter(object):
+    """
+    Write messages in 'human' format.
+
+    Column widths depend on every message, so messages are held until
+    close() and written with msgs_human().
+    """
+    def __init__(self, fh, header, fields=FIELDS):
+        self.fh = fh
+        self.header = header
+        self.fields = fields
+        self.messages = []
+
+    def write(self, msg):
+        self.messages.append(msg)
+
+    def close(self):
+        self.fh.write(msgs_human(self.messages, self.header, self.fields))
+
+class CsvWriter(object):
+    """Write messages in .csv format, one row as each message arrives."""
+    def __init__(self, fh, header, fields=FIELDS):
+        self.fh = fh
+        self.fields = fields
+        self.writer = csv.writer(fh, dialect=csv.excel, quoting=csv.QUOTE_ALL)
+        if header:
+            self.writer.writerow([f.capitalize() for f in fields])
+
+    def write(self, msg):
+        self.writer.writerow([msg[f].encode('utf-8') for f in self.fields])
+
+    def close(self):
+        pass
+
+class JsonWriter(object):
+    """
+    Write messages as a JSON list, one element as each message arrives.
+
+    Output is the same as json.dumps() of the whole list with indent=2.
+    """
+    def __init__(self, fh, header=False, fields=FIELDS):
+        self.fh = fh
+        self.count = 0
+
+    def write(self, msg):
+        obj = json.dumps(msg, sort_keys=True, indent=2, ensure_ascii=False)
+        if self.count == 0:
+            self.fh.write('[\n  ')
+        else:
+            self.fh.write(', \n  ')
+        self.fh.write(obj.replace('\n', '\n  ').encode('utf-8'))
+        self.count += 1
+
+    def close(self):
+        if self.count == 0:
+            self.fh.write('[]')
+        else:
+            self.fh.write('\n]')
+
+FORMATS = ('human', 'csv', 'json')
+WRITERS = {'human': HumanWriter, 'csv': CsvWriter, 'json': JsonWriter}
+
+def open_writers(formats, out_file, header, fields=FIELDS):
+    """
+    Return list of (writer, file handle) for each 'format[:file]' spec in
+    formats.  Formats without their own file go to out_file, or STDOUT.
+    """
+    writers = []
+    for spec in formats or ['human']:
+        format, fmt_file = split_format(spec)
+        fmt_file = fmt_file or out_file
+        if fmt_file:
+            fh = open(fmt_file, 'w')
+        else:
+            fh = sys.stdout
+        writers.append((WRITERS[format](fh, header, fields), fh))
+    return writers
+
+def output(records, writers, aliases, cmd_args):
+    """
+    Format each record once, and pass the message to every writer.
+
+    Writers and their files are closed when done.
+    """
+    try:
+        for record in records:
+            msg = format_record(record, aliases, cmd_args)
+            for writer, fh in writers:
+                writer.write(msg)
+        for writer, fh in writers:
+            writer.close()
+    finally:
+        for writer, fh in writers:
+            fh.close()
+
+# Largest SQLite INTEGER, and so largest rowid.
+MAX_ROWID = 2 ** 63 - 1
+
+class MessageStore(object):
+    """
+    Serve pages of conversations from an open connection to the DB copy.
+
+    Conversations (msg_group on iOS5, chat on iOS6), and the handles and
+    aliases of their members, are resolved once when the store is created.
+    Pages use keyset pagination on message rowid: each page is an index seek
+    to the first rowid after `after`, so a page deep in the history costs
+    the same as the first one.
+    """
+    default_limit = 100
+    max_limit = 1000
+
+    def __init__(self, conn, aliases, cmd_args):
+        self.conn = conn
+        self.aliases = aliases
+        self.cmd_args = cmd_args
+        cur = conn.cursor()
+        self.db_version = which_db_version(cur)
+        if self.db_version == '5':
+            cur.execute("CREATE INDEX IF NOT EXISTS sms_backup_group_idx "
+                        "ON message (group_id)")
+            self.handles = {}
+            self.convos = self.load_conversations(cur)
+        elif self.db_version == '6':
+            cur.execute("CREATE INDEX IF NOT EXISTS sms_backup_chat_idx "
+                        "ON chat_message_join (chat_id, message_id)")
+            cur.execute("SELECT rowid, id FROM handle")
+            self.handles = dict((row[0], normalize_handle(row[1]))
+                                for row in cur)
+            self.group_chats, self.single_chats = load_participants(cur)
+            self.schema = ios6_schema(cur)
+            self.convos = self.load_conversations_ios6(cur)
+
+    def display_name(self, handle, address):
+        """Return alias for handle, if any.  Otherwise, address."""
+        return self.aliases.get(handle, address)
+
+    def load_conversations(self, cursor):
+        """Return dict of iOS5 conversations (msg_group), keyed by id."""
+        cursor.execute("""
+SELECT
+    group_id,
+    COALESCE(madrid_handle, address) AS address,
+    COUNT(*) AS count
+FROM message
+GROUP BY group_id""")
+        convos = {}
+        for row in cursor:
+            if not row['address']:
+                continue
+            handle = normalize_handle(row['address'])
+            convos[row['group_id']] = {
+                'id': row['group_id'],
+                'name': self.display_name(handle, 
+                                          format_address(row['address'])),
+                'count': row['count']}
+        return convos
+
+    def load_conversations_ios6(self, cursor):
+        """Return dict of iOS6 conversations (chat), keyed by id."""
+        cursor.execute("""
+SELECT
+    c.rowid AS rowid,
+    c.chat_identifier AS chat_identifier,
+    COUNT(cmj.message_id) AS count
+FROM chat c
+LEFT JOIN chat_message_join cmj ON cmj.chat_id = c.rowid
+GROUP BY c.rowid""")
+        convos = {}
+        for row in cursor:
+            # Group chats have an identifier like 'chat123...', not an address.
+            name = row['chat_identifier']
+            if row['rowid'] in self.group_chats:
+                name = u', '.join(self.display_name(h, h) 
+                                  for h in self.group_chats[row['rowid']])
+            elif '@' in name or valid_phone(name):
+                handle = normalize_handle(name)
+                name = self.display_name(handle, handle)
+            convos[row['rowid']] = {
+                'id': row['rowid'],
+                'name': name,
+                'count': row['count']}
+        return convos
+
+    def conversations(self):
+        """Return list of conversations, ordered by id."""
+        return [self.convos[k] for k in sorted(self.convos)]
+
+    def page(self, convo_id, after, limit):
+        """
+        Return page of up to `limit` messages in conversation, with rowid
+        greater than `after`, and the `after` value for the next page (None,
+        if this is the last page).
+
+        Skipped rows don't count toward `limit`: rows are scanned in batches
+        until one message past the page is found, or the conversation ends.
+        """
+        # SQLite treats a negative LIMIT as no limit at all.
+        limit = max(1, min(limit or self.default_limit, self.max_limit))
+        messages = []
+        last = after
+        while len(messages) <= limit:
+            rows = self.scan(convo_id, last, limit + 1)
+            for row in rows:
+                last = row['rowid']
+                record = self.to_record(row)
+                if record is None:
+                    continue
+                msg = format_record(record, self.aliases, self.cmd_args)
+                msg['id'] = row['rowid']
+                messages.append(msg)
+                if len(messages) > limit:
+                    break
+            if len(rows) <= limit:
+                break
+        if len(messages) > limit:
+            return messages[:limit], messages[limit - 1]['id']
+        return messages, None
+
+    def scan(self, convo_id, after, count):
+        """Return list of up to `count` rows in conversation after `after`."""
+        cur = self.conn.cursor()
+        if self.db_version == '5':
+            cur.execute("""
+SELECT 
+    rowid, date, address, text, flags, group_id, madrid_handle, madrid_flags,
+    madrid_error, is_madrid, madrid_date_read, madrid_date_delivered,
+    madrid_guid
+FROM message
+WHERE group_id = ? AND rowid > ?
+ORDER BY rowid
+LIMIT ?""", (convo_id, after, count))
+        elif self.db_version == '6':
+            cur.execute("""
+SELECT
+    m.rowid AS rowid,
+    m.date AS date,
+    m.is_from_me AS is_from_me,
+    m.handle_id AS handle_id,
+    m.text AS text,
+    m.guid AS guid,
+    cmj.chat_id AS chat_id,
+    %s AS attributedBody
+FROM chat_message_join cmj
+JOIN message m ON m.rowid = cmj.message_id
+WHERE cmj.chat_id = ? AND cmj.message_id > ?
+ORDER BY cmj.message_id
+LIMIT ?""" % ('m.attributedBody' if self.schema['attributed_body'] 
+              else 'NULL'), (convo_id, after, count))
+        return cur.fetchall()
+
+    def to_record(self, row):
+        """Return normalized record for row, or None if row is skipped."""
+        if self.db_version == '5':
+            if row['is_madrid'] == 1:
+                if skip_imessage(row): return None
+                return imessage_record(row)
+            else:
+                if skip_sms(row): return None
+                return sms_record(row)
+        elif self.db_version == '6':
+            handle = (self.handles.get(row['handle_id']) or 
+                      self.single_chats.get(row['chat_id']))
+            participants = self.group_chats.get(row['chat_id'])
+            if skip_ios6(row, handle, participants): return None
+            return ios6_record(row, handle, participants, 
+                               self.schema['date_divisor'])
+
+class MessageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer JSON requests for the MessageStore in `self.server.store`:
+
+        GET /conversations
+        GET /conversations/<id>/messages?after=<rowid>&limit=<n>
+    """
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        store = self.server.store
+        try:
+            if url.path == '/conversations':
+                self.send_json(200, {'conversations': store.conversations()})
+                return
+            m = re.search(r'^/conversations/(\d+)/messages$', url.path)
+            if not m:
+                self.send_json(404, {'error': 'Not found.'})
+                return
+            convo_id = int(m.group(1))
+            if convo_id not in store.convos:
+                self.send_json(404, {'error': 'No such conversation.'})
+                return
+            after = int(query.get('after', ['0'])[0])
+            limit = int(query.get('limit', ['0'])[0])
+        except ValueError:
+            self.send_json(400, {'error': "'after' and 'limit' must be "
+                                          "integers."})
+            return
+        if after < 0 or limit < 0:
+            self.send_json(400, {'error': "'after' and 'limit' must not be "
+                                          "negative."})
+            return
+        if after > MAX_ROWID:
+            self.send_json(400, {'error': "'after' must be at most %d." % \
+                                          MAX_ROWID})
+            return
+        messages, next_after = store.page(convo_id, after, limit)
+        self.send_json(200, {'messages': messages, 'next': next_after})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj, sort_keys=True, ensure_ascii=False)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+def serve(conn, aliases, cmd_args):
+    """Serve messages over HTTP until interrupted."""
+    host, port = split_serve(cmd_args.serve)
+    server = BaseHTTPServer.HTTPServer((host, port), MessageRequestHandler)
+    server.store = MessageStore(conn, aliases, cmd_args)
+    logging.info("Serving %d conversations on http://%s:%d/conversations" % \
+                    (len(server.store.convos), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 def main():
         parser = argparse.ArgumentParser()
@@ -742,26 +1605,40 @@ def main():
         
         global ORIG_DB, COPY_DB 
         ORIG_DB = args.db_file or find_sms_db()
-        COPY_DB = copy_sms_db(ORIG_DB)
         aliases = alias_map(args.aliases)
 
+        records = None
+        cache_key = None
+        if args.cache_dir and not args.serve and not args.old_db_file:
+            cache_key = db_fingerprint(ORIG_DB)
+            records = load_cached_records(args.cache_dir, cache_key)
+
         conn = None
 
         try:
-            conn = sqlite3.connect(COPY_DB)
-            conn.row_factory = sqlite3.Row
-            conn.create_function("TRUNC", 1, trunc)
-            cur = conn.cursor()
-
-            ios_db_version = which_db_version(cur)
-            if ios_db_version == '5':
-                query, params = build_msg_query(args.numbers, args.emails)
-                messages = get_messages(cur, query, params, aliases, args)
-            elif ios_db_version == '6':
-                query, params = build_msg_query_ios6(args.numbers, args.emails)
-                messages = get_messages_ios6(cur, query, params, aliases, args)
-
-            output(messages, args.output, args.format, args.header)
+            if records is None:
+                COPY_DB = copy_sms_db(ORIG_DB)
+                conn = connect_db(COPY_DB)
+                cur = conn.cursor()
+
+                if args.serve:
+                    serve(conn, aliases, args)
+                    return
+                elif args.old_db_file:
+                    diff(cur, aliases, args)
+                    return
+                elif cache_key:
+                    # Cache every message, so the entry serves any filter.
+                    records = list(extract_records(cur, None, None))
+                    save_cached_records(args.cache_dir, cache_key, records,
+                                        args.cache_size)
+                else:
+                    records = extract_records(cur, args.numbers, args.emails)
+
+            if cache_key:
+                records = filter_records(records, args.numbers, args.emails)
+            writers = open_writers(args.formats, args.output, args.header)
+            output(records, writers, aliases, args)
 
         except sqlite3.Error as e:
             logging.error("Unable to access %s: %s" % (COPY_DB, e))